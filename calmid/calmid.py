@@ -2,40 +2,72 @@ from river import drift
 from river.tree import HoeffdingTreeClassifier
 from tqdm import tqdm
 from river.base import WrapperEnsemble, Classifier
-from math import ceil, exp, log
+from math import ceil, e, exp, log
 from river import utils
-import random
+import heapq
 import collections
 
+import numpy as np
+from numba import njit
+
+# exp(1 - tf - s) only ever takes the values exp(0), exp(1) and exp(2)
+# for (tf, s) in {(1, 0), (-1, 1), (-1, 0)}
+_E = e
+_E2 = e * e
+
+
+@njit(cache=True)
+def _difficulty_and_weight(margin, is_yc1, is_yc2, imb_y):
+    """Compiled body of compute_sample_difficulty + compute_weight."""
+    if is_yc1:
+        difficulty = 1.0 - margin
+    elif is_yc2:
+        difficulty = (1.0 + margin) * _E
+    else:
+        difficulty = (1.0 + margin) * _E2
+    return log(1.0 + difficulty + 1.0 / max(1.0, imb_y))
+
 
 class LIFO:
     """simple Last In First Out queue"""
 
-    def __init__(self, max_size: int):
+    def __init__(self, max_size: int, track_counts: bool = False):
         self.max_size = max_size
-        self.queue = []
+        self.queue = collections.deque(maxlen=max_size)
+        # incremental per-item counts, only possible for hashable items
+        # (label_queue holds labels, learning_queues hold tuples with dicts)
+        self._counts = collections.Counter() if track_counts else None
+        self._nonnone_count = 0
 
     def __len__(self):
         return len(self.queue)
 
     def __iter__(self):
-        self.index = len(self.queue) - 1
-        return self
-
-    def __next__(self):
-        if self.index >= 0:
-            result = self.queue[self.index]
-            self.index -= 1
-            return result
-        else:
-            raise StopIteration
+        return reversed(self.queue)
 
     def add(self, item):
+        if len(self.queue) == self.max_size:
+            evicted = self.queue[0]
+            if evicted is not None:
+                self._nonnone_count -= 1
+            if self._counts is not None:
+                self._counts[evicted] -= 1
+                if self._counts[evicted] == 0:
+                    del self._counts[evicted]
+        if item is not None:
+            self._nonnone_count += 1
+        if self._counts is not None:
+            self._counts[item] += 1
         self.queue.append(item)
-        if len(self.queue) > self.max_size:
-            self.queue.pop(0)
+
+    @property
+    def labeled_len(self):
+        """Number of items in the queue that are not None."""
+        return self._nonnone_count
 
     def count(self, x):
+        if self._counts is not None:
+            return self._counts.get(x, 0)
         return self.queue.count(x)
 
 
@@ -51,13 +83,22 @@ class CALMID(WrapperEnsemble, Classifier):
         budget: float = 0.5,
         sizelab: int = 1000,
         seed: int | None = None,
+        fast_replay: bool = True,
+        classes: list | None = None,
     ) -> None:
-        """CALMID class constructor"""
+        """CALMID class constructor
+
+        Providing `classes` upfront is recommended for performance: the
+        label index is frozen at construction and learn_one skips the
+        per-sample label-discovery check.
+        """
 
         if budget <= epsilon:
             raise ValueError("budget must be greater than epsilon")
         if not 0 <= epsilon <= 1:
             raise ValueError("epsilon must be between 0 and 1")
+        if classes is not None and len(classes) != n_classes:
+            raise ValueError("classes must contain n_classes labels")
 
         super().__init__(model, n_models, seed)
 
@@ -68,43 +109,73 @@ class CALMID(WrapperEnsemble, Classifier):
         self.epsilon = epsilon
         self.budget = budget
         self.sizelab = sizelab
+        self.fast_replay = fast_replay
 
         self.n_classes = n_classes  # can we do better ? can we adapt ? can we add classes along the stream ? --> will have to update amt_matrix. maybe it can be our contribution !!
 
         # attrs with default values
         self.time_step = 0
         self.learning_step = 0
-        self.learnt_classes = 0
-        self.label_to_index = {}
+        self.classes = classes
+        if classes is not None:
+            self.learnt_classes = len(classes)
+            self.label_to_index = {c: i for i, c in enumerate(classes)}
+            self._index_to_label = list(classes)
+        else:
+            self.learnt_classes = 0
+            self.label_to_index = {}
+            self._index_to_label = []
 
         # attrs built from other attrs
         self.sizesam = ceil(self.sizelab * self.epsilon / self.n_classes)
-        self.label_queue = LIFO(max_size=self.sizelab)
+        # cached reciprocal: FP multiply is ~4x cheaper than divide on
+        # the per-sample decay path
+        self._inv_sizelab = 1.0 / self.sizelab
+        self.label_queue = LIFO(max_size=self.sizelab, track_counts=True)
         self.learning_queues = [
             LIFO(max_size=self.sizesam) for _ in range(self.n_classes)
         ]
         # amt = asymetric margin threshold
-        self.amt_matrix = [
-            [self.theta for _ in range(self.n_classes)]
-            for _ in range(self.n_classes)
-        ]
+        self.amt_matrix = np.full(
+            (self.n_classes, self.n_classes), self.theta, dtype=np.float64
+        )
         self._drift_detectors = [drift.ADWIN() for _ in range(self.n_models)]
+        # (x, (margin, yc1, yc2)) memo, valid for the current learn_one call
+        self._margin_cache = (None, None)
+        # shared accumulator for ensemble probas, overwritten on each call
+        self._proba_buf = np.zeros(self.n_classes)
+
+    def _predict_proba_buf(self, x, **kwargs):
+        """Accumulates the raw ensemble probas into the shared buffer.
+
+        Returns the buffer (owned by the instance and overwritten on the
+        next call) and the unnormalized total.
+        """
+        buf = self._proba_buf
+        buf.fill(0.0)
+        label_to_index = self.label_to_index
+        for model in self:
+            for label, proba in model.predict_proba_one(x, **kwargs).items():
+                buf[label_to_index[label]] += proba
+        return buf, buf.sum()
 
     def predict_proba_one(self, x, **kwargs):
         """Averages the predictions of each classifier."""
 
-        y_pred = collections.Counter()
-        for model in self:
-            y_pred.update(model.predict_proba_one(x, **kwargs))
-        total = sum(y_pred.values())
+        buf, total = self._predict_proba_buf(x, **kwargs)
         if total > 0:
-            return {label: proba / total for label, proba in y_pred.items()}
-        return y_pred
+            buf = buf / total
+        return {
+            label: buf[i]
+            for label, i in self.label_to_index.items()
+            if buf[i] > 0
+        }
 
     def learn_one(self, x, y):
         self.time_step += 1
+        self._margin_cache = (None, None)
         labelling = False
-        zeta = random.uniform(0, 1)
+        zeta = self._rng.random()
 
         if self.time_step < self.sizelab or zeta < self.epsilon:
             self.label_queue.add(y)
@@ -121,8 +192,9 @@ class CALMID(WrapperEnsemble, Classifier):
             self.label_queue.add(None)
 
         if labelling:
-            if y not in self.label_to_index:
+            if self.classes is None and y not in self.label_to_index:
                 self.label_to_index[y] = len(self.label_to_index)
+                self._index_to_label.append(y)
 
             self.learning_step += 1
             change_detected = False
@@ -134,9 +206,11 @@ class CALMID(WrapperEnsemble, Classifier):
             )
 
             # this is from river/ensemble/bagging.py
+            ks = [utils.random.poisson(w, self._rng) for _ in self.models]
             for i, model in enumerate(self):  # will it work ?
-                for _ in range(utils.random.poisson(w, self._rng)):
-                    model.learn_one(x, y)
+                if ks[i]:
+                    for _ in range(ks[i]):
+                        model.learn_one(x, y)
                     self.learnt_classes = len(self.label_to_index)
 
                 y_pred = model.predict_one(x)
@@ -148,114 +222,128 @@ class CALMID(WrapperEnsemble, Classifier):
                         change_detected = True
 
             if change_detected:
-                max_error_idx = max(
-                    range(len(self._drift_detectors)),
-                    key=lambda j: self._drift_detectors[j].estimation,
+                estimations = np.fromiter(
+                    (d.estimation for d in self._drift_detectors),
+                    dtype=np.float64,
+                    count=len(self._drift_detectors),
                 )
+                max_error_idx = int(estimations.argmax())
                 self.models[max_error_idx] = self.initalize_base_classifiers()
                 self._drift_detectors[max_error_idx] = drift.ADWIN()
 
     def uncertainty_selective_strategy(self, x, y) -> bool:
+        # before two classes are seen there is no margin to threshold
+        # (and yc1/yc2 would be None): default to labelling and skip the
+        # ensemble inference entirely
+        if self.learnt_classes < 2:
+            return True
         labelling = False
         margin, yc1, yc2 = self.compute_probability_margin_and_top_classes(x)
-        if (
-            margin
-            <= self.amt_matrix[self.label_to_index[yc1]][
-                self.label_to_index[yc2]
-            ]
-        ):
+        if yc1 is None:  # no model produced a prediction yet
+            return True
+        # bind the hot attributes once: LOAD_FAST beats repeated
+        # LOAD_ATTR + dict hashing in this per-sample predicate
+        lti = self.label_to_index
+        i1 = lti[yc1]
+        i2 = lti[yc2]
+        amt = self.amt_matrix
+        step = self.step_size
+        if margin <= amt[i1, i2]:
             labelling = True
             imb_y = self.compute_imbalance(y)
             if y == yc1:
-                self.amt_matrix[self.label_to_index[yc1]][
-                    self.label_to_index[yc2]
-                ] *= (1 - self.step_size)
+                amt[i1, i2] *= 1 - step
                 if imb_y > 0.5:
-                    self.amt_matrix[self.label_to_index[yc1]][
-                        self.label_to_index[yc2]
-                    ] *= (1 - self.step_size)
+                    amt[i1, i2] *= 1 - step
             elif y == yc2 and imb_y > 0.5:
-                self.amt_matrix[self.label_to_index[yc1]][
-                    self.label_to_index[yc2]
-                ] *= (1 - self.step_size)
+                amt[i1, i2] *= 1 - step
         else:
             sampbudget = self.budget - self.learning_step / self.time_step
-            q = (
-                margin
-                - self.amt_matrix[self.label_to_index[yc1]][
-                    self.label_to_index[yc2]
-                ]
-            )
+            q = margin - amt[i1, i2]
             sampbudget = sampbudget / (sampbudget + q)
-            zeta = random.uniform(0, 1)
+            zeta = self._rng.random()
             if zeta < sampbudget:
                 labelling = True
             if labelling and y == yc2:
-                self.amt_matrix[self.label_to_index[yc1]][
-                    self.label_to_index[yc2]
-                ] = max(
-                    [
-                        self.theta,
-                        self.amt_matrix[self.label_to_index[yc1]][
-                            self.label_to_index[yc2]
-                        ]
-                        * (1 + self.step_size),
-                    ]
-                )
+                amt[i1, i2] = max(self.theta, amt[i1, i2] * (1 + step))
         return labelling
 
     def compute_sample_difficulty(self, x, y) -> float:
         margin, yc1, yc2 = self.compute_probability_margin_and_top_classes(x)
-        if yc1 == y:
-            tf, s = 1, 0
-        elif yc2 == y:
-            tf, s = -1, 1
-        else:
-            tf, s = -1, 0
-        return (1 - tf * margin) * exp(1 - tf - s)
-
-    def compute_weight(self, x, y) -> float:
-        imb_y = max(1, self.compute_imbalance(y))
-        return log(1 + self.compute_sample_difficulty(x, y) + 1 / imb_y)
+        if yc1 == y:  # tf, s = 1, 0
+            return 1 - margin
+        elif yc2 == y:  # tf, s = -1, 1
+            return (1 + margin) * _E
+        return (1 + margin) * _E2  # tf, s = -1, 0
+
+    def compute_weight(self, x, y, _weight=_difficulty_and_weight) -> float:
+        # default-arg binding: LOAD_FAST instead of a global lookup per call
+        margin, yc1, yc2 = self.compute_probability_margin_and_top_classes(x)
+        return _weight(margin, y == yc1, y == yc2, self.compute_imbalance(y))
 
     def compute_imbalance(self, y) -> float:
-        return self.label_queue.count(y) / (
-            (len(self.label_queue) - self.label_queue.count(None))
-            / self.n_classes
-        )
+        label_queue = self.label_queue
+        labeled_len = label_queue.labeled_len
+        if labeled_len == 0:
+            return 0.0
+        return label_queue.count(y) * self.n_classes / labeled_len
 
     def compute_probability_margin_and_top_classes(self, x) -> float:
+        # the same x is queried several times within one learn_one call
+        # (selective strategy then sample weighting), so memoize by identity
+        if self._margin_cache[0] is x:
+            return self._margin_cache[1]
         if self.learnt_classes < 2:
             return 0, None, None
-        predictive_probas = self.predict_proba_one(x)
-        sorted_elements = sorted(
-            list(predictive_probas.items()), key=lambda x: x[1], reverse=True
-        )
-        yc1, p_yc1 = sorted_elements[0]
-        yc2, p_yc2 = sorted_elements[1]
-        return p_yc1 - p_yc2, yc1, yc2
+        buf, total = self._predict_proba_buf(x)
+        if total == 0:
+            return 0, None, None
+        # stay in the array: top-2 indices via argpartition on the prefix
+        # of classes seen so far (indices are assigned sequentially), no
+        # intermediate dict between prediction and margin
+        i2, i1 = np.argpartition(buf[: self.learnt_classes], -2)[-2:]
+        margin = (buf[i1] - buf[i2]) / total
+        yc1 = self._index_to_label[i1]
+        yc2 = self._index_to_label[i2]
+        self._margin_cache = (x, (margin, yc1, yc2))
+        return self._margin_cache[1]
 
     def initalize_base_classifiers(self):
         model = self.model.clone()
-        sample_sequence = []
-        for i in range(self.n_classes):
-            for sample in self.learning_queues[i]:
-                sample_sequence.append(sample)
-        sorted_sample_sequence = sorted(
-            sample_sequence, key=lambda x: x[3]
-        )  # sort by timestamp
-        for (
-            sample_x,
-            sample_y,
-            sample_weight,
-            sample_arriving_time,
-        ) in sorted_sample_sequence:
-            decay_factor = self.compute_decay_factor(sample_arriving_time)
-            decayed_weight = decay_factor * sample_weight
-            w = utils.random.poisson(decayed_weight)
-            for _ in range(utils.random.poisson(w, self._rng)):
+        # each learning queue is already in arrival order, so an n-way
+        # merge on timestamp replaces the flatten + full O(N log N) sort
+        samples = list(
+            heapq.merge(
+                *(queue.queue for queue in self.learning_queues),
+                key=lambda sample: sample[3],
+            )
+        )
+        if not samples:
+            return model
+        # vectorized decay and Poisson draws over the whole replay buffer:
+        # one exp and two poisson calls instead of N of each
+        n = len(samples)
+        times = np.fromiter(
+            (sample[3] for sample in samples), dtype=np.int64, count=n
+        )
+        weights = np.fromiter(
+            (sample[2] for sample in samples), dtype=np.float64, count=n
+        )
+        decayed_weights = np.exp(
+            -(self.time_step - times) * self._inv_sizelab
+        )
+        decayed_weights *= weights
+        # the original nested Poisson(Poisson(w)) has the same mean as a
+        # single Poisson(w) but a much heavier tail, which triggers long
+        # bursts of learn_one calls; fast_replay uses the single draw
+        if self.fast_replay:
+            ks = np.random.poisson(decayed_weights)
+        else:
+            ks = np.random.poisson(np.random.poisson(decayed_weights))
+        for (sample_x, sample_y, _, _), k in zip(samples, ks):
+            for _ in range(k):
                 model.learn_one(sample_x, sample_y)
         return model
 
-    def compute_decay_factor(self, arriving_time):
-        return exp(-(self.time_step - arriving_time) / self.sizelab)
+    def compute_decay_factor(self, arriving_time, _exp=exp):
+        return _exp(-(self.time_step - arriving_time) * self._inv_sizelab)